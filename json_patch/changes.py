@@ -0,0 +1,114 @@
+from collections import OrderedDict
+
+
+class Change(object):
+    """
+    A row touched by a patch. ``fields`` maps the name of each field written
+    to an ``(old, new)`` tuple of values. Values of many to many fields are
+    not tracked and are None.
+    """
+    __slots__ = ('model', 'pk', 'action', 'fields')
+
+    CREATED = 'created'
+    UPDATED = 'updated'
+    DELETED = 'deleted'
+
+    def __init__(self, model, pk, action, fields=None):
+        self.model = model
+        self.pk = pk
+        self.action = action
+        self.fields = fields if fields is not None else {}
+
+    def __repr__(self):
+        return '<Change: {0} {1} {2} {3}>'.format(
+            self.action, self.model.__name__, self.pk, sorted(self.fields))
+
+
+class ChangeSet(object):
+    """
+    Rows created, updated and deleted while applying a patch, one
+    :class:`Change` per (model, pk) in the order they were first touched.
+    ``inverse`` is a patch reverting them.
+    """
+    __slots__ = ('changes', 'inverse')
+
+    def __init__(self):
+        self.changes = OrderedDict()
+        self.inverse = None
+
+    def __iter__(self):
+        return iter(self.changes.values())
+
+    def __len__(self):
+        return len(self.changes)
+
+    def __bool__(self):
+        return bool(self.changes)
+
+    __nonzero__ = __bool__
+
+    def __contains__(self, key):
+        return key in self.changes
+
+    def __repr__(self):
+        return '<ChangeSet: {0} created, {1} updated, {2} deleted>'.format(
+            len(self.created), len(self.updated), len(self.deleted))
+
+    def get(self, model, pk):
+        return self.changes.get((model, pk))
+
+    @property
+    def created(self):
+        return self.filter(Change.CREATED)
+
+    @property
+    def updated(self):
+        return self.filter(Change.UPDATED)
+
+    @property
+    def deleted(self):
+        return self.filter(Change.DELETED)
+
+    def filter(self, action):
+        return [change for change in self if change.action == action]
+
+    def get_triples(self, action):
+        return [
+            (change.model, change.pk, tuple(change.fields))
+            for change in self.filter(action)
+        ]
+
+    def record_created(self, model, pk, values):
+        """
+        Record a new row, ``values`` mapping field name to the value saved.
+        """
+        change = Change(model, pk, Change.CREATED)
+        for name, value in values.items():
+            change.fields[name] = (None, value)
+        self.changes[(model, pk)] = change
+
+    def record_updated(self, model, pk, values):
+        """
+        Record fields written on an existing row, ``values`` mapping field
+        name to an ``(old, new)`` tuple. The first old value seen is kept.
+        """
+        key = (model, pk)
+        change = self.changes.get(key)
+        if change is None:
+            change = self.changes[key] = Change(model, pk, Change.UPDATED)
+        for name, (old, new) in values.items():
+            if name in change.fields:
+                old = change.fields[name][0]
+            change.fields[name] = (old, new)
+
+    def record_deleted(self, model, pk):
+        key = (model, pk)
+        change = self.changes.get(key)
+        if change is None:
+            self.changes[key] = Change(model, pk, Change.DELETED)
+        elif change.action == Change.CREATED:
+            # Created and deleted within the same patch, nothing changed
+            del self.changes[key]
+        else:
+            change.action = Change.DELETED
+            change.fields = {}
@@ -0,0 +1,83 @@
+import django
+from django.db import router, transaction
+from django.db.models import sql
+from django.db.models.deletion import Collector
+
+
+def iterate(queryset, chunk_size):
+    """
+    Iterate over ``queryset`` without caching its results, fetching
+    ``chunk_size`` rows at a time on Django versions that support it.
+    """
+    if django.VERSION >= (2, 0):
+        return queryset.iterator(chunk_size=chunk_size)
+    return queryset.iterator()
+
+
+def save_object(obj, using=None, update_fields=None, signals=True):
+    """
+    Save ``obj`` as ``Model.save()`` does. With ``signals=False`` the save
+    is done without sending ``pre_save`` / ``post_save``, and without
+    calling an overridden ``save()``.
+    """
+    if signals:
+        obj.save(using=using, update_fields=update_fields)
+        return
+
+    using = using or router.db_for_write(obj.__class__, instance=obj)
+    cls = obj.__class__
+    if cls._meta.proxy:
+        cls = cls._meta.concrete_model
+    with transaction.atomic(using=using, savepoint=False):
+        obj._save_parents(cls, using, update_fields)
+        obj._save_table(cls=cls, using=using, update_fields=update_fields)
+    obj._state.db = using
+    obj._state.adding = False
+
+
+def delete_object(obj, using=None, signals=True):
+    """
+    Delete ``obj`` and the rows cascading from it. With ``signals=False``
+    the rows are deleted without sending ``pre_delete`` / ``post_delete``,
+    and without calling an overridden ``delete()``.
+
+    Returns a list of (model, pk) for every row deleted.
+    """
+    using = using or router.db_for_write(obj.__class__, instance=obj)
+    collector = Collector(using=using)
+    collector.collect([obj])
+    deleted = [
+        (model, instance.pk)
+        for model, instances in collector.data.items()
+        for instance in instances
+        if not model._meta.auto_created
+    ]
+    for queryset in collector.fast_deletes:
+        # Rows deleted in bulk are not loaded by the collector
+        if not queryset.model._meta.auto_created:
+            deleted.extend(
+                (queryset.model, pk) for pk in queryset.values_list('pk', flat=True))
+
+    if signals:
+        obj.delete(using=using)
+        return deleted
+
+    collector.sort()
+    with transaction.atomic(using=using, savepoint=False):
+        for queryset in collector.fast_deletes:
+            queryset._raw_delete(using=using)
+
+        for model, instances_for_fieldvalues in collector.field_updates.items():
+            query = sql.UpdateQuery(model)
+            for (field, value), instances in instances_for_fieldvalues.items():
+                query.update_batch(
+                    [instance.pk for instance in instances], {field.name: value}, using)
+
+        for model, instances in collector.data.items():
+            query = sql.DeleteQuery(model)
+            query.delete_batch([instance.pk for instance in instances], using)
+
+    for model, instances in collector.data.items():
+        for instance in instances:
+            setattr(instance, model._meta.pk.attname, None)
+    return deleted
@@ -4,3 +4,15 @@ class PointerException(Exception):
 
 class PatchException(Exception):
     pass
+
+
+class PatchValidationError(PatchException):
+    """
+    Raised when a patch document is malformed, with ``errors`` listing
+    every problem found.
+    """
+
+    def __init__(self, errors):
+        self.errors = errors
+        super(PatchValidationError, self).__init__(
+            'Invalid patch: {0}'.format('; '.join(errors)))
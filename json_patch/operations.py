@@ -1,7 +1,13 @@
+import copy
+import json
+
+from django.core.exceptions import FieldDoesNotExist, FieldError, ValidationError
+from django.db import connections, router
 from django.db.models import Model, QuerySet
-from django.forms import modelform_factory
 
-from .exceptions import PatchException
+from . import db
+from .db import iterate
+from .exceptions import PatchException, PointerException
 from .pointers import Pointer
 
 
@@ -11,9 +17,15 @@ class PatchOperation(object):
         self.patch = patch
         self.path = path
         self.value = value
-        self.pointer = Pointer(self.path)
+        self.pointer = Pointer(
+            self.path,
+            flush=getattr(patch, 'flush_relation', None),
+            ordering=getattr(patch, 'ordering', None),
+            using=getattr(patch, 'read_using', None))
 
     def get_form_class(self, obj, fields=None):
+        from django.forms import modelform_factory
+
         if not fields:
             fields = '__all__'
         if not isinstance(obj, Model):
@@ -36,6 +48,242 @@ class PatchOperation(object):
     def apply(self, obj, save=True):
         raise NotImplementedError('Logic to implement patch')
 
+    def get_lock_targets(self, obj):
+        """
+        Return the instances of the existing rows this operation will write,
+        resolved before the patch is applied so they can be locked up front.
+        """
+        try:
+            obj, attribute = self.pointer.to_last(obj)
+            target = self.get_lock_target(obj, attribute)
+        except PointerException:
+            # The target may only exist once earlier operations have run
+            return []
+
+        if isinstance(target, Model):
+            return [target]
+        return []
+
+    def get_lock_target(self, obj, attribute):
+        if self.pointer.document is not None:
+            return self.pointer.document[0]
+        if self.pointer.relation is not None:
+            return self.pointer.relation[0]
+        return obj
+
+    def add_inverse(self, op, path, **members):
+        """
+        Record the operation undoing this one in the patch's inverse.
+        """
+        if self.patch.inverse_operations is None:
+            # Not collected, e.g. by ``apply_many``
+            return
+        operation = {'op': op, 'path': path}
+        operation.update(members)
+        self.patch.inverse_operations.append(operation)
+
+    def get_sibling_path(self, part):
+        """
+        Path of ``part`` in the same container as the target location, with
+        the rows passed through addressed by pk rather than index.
+        """
+        parts = self.pointer.keyed_parts[:len(self.pointer.parts) - 1] + [part]
+        return '/' + '/'.join(Pointer.escape(part) for part in parts)
+
+    def get_inverse_path(self):
+        """
+        Path of the target location, as used by inverse operations.
+        """
+        parts = self.pointer.parts
+        if not parts:
+            return self.path
+        return self.get_sibling_path(parts[-1])
+
+    def get_object_data(self, obj):
+        """
+        Values of the editable fields of ``obj``, as ``add`` expects them.
+        """
+        data = {}
+        for field in obj._meta.concrete_fields:
+            if field.editable and not field.auto_created:
+                data[field.name] = field.value_from_object(obj)
+        return data
+
+    def get_related_pks(self, obj, name):
+        return list(getattr(obj, name).values_list('pk', flat=True))
+
+    def get_field_values(self, obj, fields):
+        values = {}
+        for name in fields:
+            try:
+                field = obj._meta.get_field(name)
+            except FieldDoesNotExist:
+                values[name] = None
+            else:
+                # Reading many to many values would need a query per field
+                values[name] = None if field.many_to_many else field.value_from_object(obj)
+        return values
+
+    def save_form(self, form, old_values=None):
+        obj = form.save(commit=False)
+        self.save_object(obj, list(form.fields), old_values=old_values)
+        form.save_m2m()
+        return obj
+
+    def save_object(self, obj, fields, update_fields=None, old_values=None):
+        """
+        Save ``obj`` and record the ``fields`` written in the patch's change
+        set. ``old_values`` maps field name to its value before the change.
+        """
+        created = obj._state.adding
+        db.save_object(
+            obj,
+            using=self.patch.get_write_db(obj.__class__),
+            update_fields=update_fields,
+            signals=self.patch.model_signals)
+
+        values = self.get_field_values(obj, fields)
+        if created:
+            self.patch.changes.record_created(obj.__class__, obj.pk, values)
+        else:
+            old_values = old_values or {}
+            self.patch.changes.record_updated(obj.__class__, obj.pk, dict(
+                (name, (old_values.get(name), value)) for name, value in values.items()))
+
+    def delete_object(self, obj):
+        deleted = db.delete_object(
+            obj, using=self.patch.get_write_db(obj.__class__), signals=self.patch.model_signals)
+        for model, pk in deleted:
+            self.patch.changes.record_deleted(model, pk)
+
+    def get_relation_name(self, obj, attribute):
+        """
+        Return ``attribute`` if it names a many to many relation on ``obj``.
+        """
+        if not isinstance(obj, Model) or attribute is None:
+            return None
+        try:
+            field = obj._meta.get_field(attribute)
+        except FieldDoesNotExist:
+            return None
+        return attribute if field.many_to_many else None
+
+    def get_related_pk(self, model, value):
+        if isinstance(value, Model):
+            return value.pk
+        if isinstance(value, dict):
+            for key in ('pk', model._meta.pk.attname, model._meta.pk.name):
+                if key in value:
+                    value = value[key]
+                    break
+            else:
+                raise PatchException('Related object has no primary key: {0}'.format(value))
+        try:
+            return model._meta.pk.to_python(value)
+        except ValidationError as e:
+            raise PatchException('Invalid primary key for {0}: {1}'.format(
+                model.__name__, e.messages))
+
+    def set_relation(self, obj, name, save=True):
+        """
+        Replace the members of the many to many relation ``name`` on ``obj``
+        with the objects listed in the value.
+        """
+        if not isinstance(self.value, (list, tuple)):
+            raise PatchException('Expected a list of related objects for: {0}'.format(name))
+        model = getattr(obj, name).model
+        pks = [self.get_related_pk(model, value) for value in self.value]
+        if save:
+            # The previous members are not known without reading them
+            self.patch.flush_relation(obj, name)
+            self.add_inverse(
+                'replace', self.get_inverse_path(), value=self.get_related_pks(obj, name))
+            self.patch.queue_relation_change(obj, name, replace=pks)
+        return obj
+
+    def in_document(self, obj):
+        """
+        Whether ``obj`` is a container inside a JSON valued model field, as
+        opposed to a collection of model instances.
+        """
+        return isinstance(obj, dict) or (
+            isinstance(obj, list) and self.pointer.document is not None)
+
+    def get_document_index(self, obj, attribute, insert=False):
+        if insert and attribute == '-':
+            return len(obj)
+        try:
+            index = int(attribute)
+        except ValueError:
+            raise PatchException('Index is not an int: {0}'.format(attribute))
+        last = len(obj) if insert else len(obj) - 1
+        if index < 0 or index > last:
+            raise PatchException('Index does not exist: {0}'.format(attribute))
+        return index
+
+    def get_document_path(self, attribute):
+        return self.pointer.document[2] + [str(attribute)]
+
+    def get_document_snapshot(self):
+        """
+        Copy of the document about to be edited in place, kept as the old
+        value in the change set. Only taken for the first edit of a document.
+        """
+        if self.pointer.document is None:
+            return None
+        instance, field, parts = self.pointer.document
+        change = self.patch.changes.get(instance.__class__, instance.pk)
+        if change is not None and field.name in change.fields:
+            return None
+        return copy.deepcopy(field.value_from_object(instance))
+
+    def save_document(self, save=True, expression=None, params=(), old=None):
+        """
+        Save the model field holding a JSON document edited in place, ``old``
+        being the document before the edit.
+
+        When ``Patch.json_partial_updates`` is set and the field is a jsonb
+        column on PostgreSQL, ``expression`` (e.g. a ``jsonb_set`` call on
+        ``{column}``) is used so only the changed sub-document is sent.
+        """
+        if self.pointer.document is None or not save:
+            return
+
+        instance, field, parts = self.pointer.document
+        try:
+            field.clean(field.value_from_object(instance), instance)
+        except ValidationError as e:
+            raise PatchException('Failed validation in field clean: {0}'.format(
+                {field.name: e.messages}))
+
+        using = (self.patch.get_write_db(instance.__class__) or
+                 router.db_for_write(instance.__class__, instance=instance))
+        connection = connections[using]
+        if (expression is None or
+                not getattr(self.patch, 'json_partial_updates', False) or
+                connection.vendor != 'postgresql' or
+                field.db_type(connection) != 'jsonb'):
+            self.save_object(
+                instance, [field.name], update_fields=[field.attname], old_values={field.name: old})
+            return
+
+        quote_name = connection.ops.quote_name
+        column = quote_name(field.column)
+        sql = 'UPDATE {table} SET {column} = {expression} WHERE {pk} = %s'.format(
+            table=quote_name(instance._meta.db_table),
+            column=column,
+            expression=expression.format(column=column),
+            pk=quote_name(instance._meta.pk.column))
+        with connection.cursor() as cursor:
+            cursor.execute(sql, list(params) + [instance.pk])
+        self.patch.changes.record_updated(instance.__class__, instance.pk, {
+            field.name: (old, field.value_from_object(instance))
+        })
+
+    def dump_document_value(self, value):
+        instance, field, parts = self.pointer.document
+        return json.dumps(value, cls=getattr(field, 'encoder', None))
+
 
 class ReplaceOperation(PatchOperation):
     """
@@ -49,6 +297,17 @@ class ReplaceOperation(PatchOperation):
     def apply(self, obj, save=True):
         obj, attribute = self.pointer.to_last(obj)
 
+        if self.in_document(obj):
+            return self.apply_document(obj, attribute, save=save)
+
+        name = self.get_relation_name(obj, attribute)
+        if name is not None:
+            return self.set_relation(obj, name, save=save)
+
+        field = self.get_fast_field(obj, attribute)
+        if field is not None:
+            return self.apply_fast(obj, field, save=save)
+
         form_kwargs = {
             'data': {
                 attribute: self.value
@@ -56,15 +315,90 @@ class ReplaceOperation(PatchOperation):
         }
 
         form_fields = [attribute, ]
+        old_values = self.get_field_values(obj, form_fields)
 
         form = self.get_form(obj, form_fields=form_fields, form_kwargs=form_kwargs)
         if form.is_valid():
             if save:
-                form.save()
+                self.save_form(form, old_values=old_values)
+                self.patch.reset_counts()
+                self.add_inverse('replace', self.get_inverse_path(), value=old_values[attribute])
         else:
             raise PatchException('Failed validation in form save: {0}'.format(form.errors))
         return obj
 
+    def get_fast_field(self, obj, attribute):
+        """
+        Return the model field for ``attribute`` when it has been opted in to
+        fast validation (see ``Patch.fast_fields``) and is simple enough to be
+        validated without a ModelForm. Returns None otherwise.
+        """
+        if not isinstance(obj, Model):
+            return None
+
+        fast_fields = getattr(self.patch, 'fast_fields', None) or {}
+        allowed = fast_fields.get(obj.__class__)
+        if allowed is None:
+            return None
+
+        try:
+            field = obj._meta.get_field(attribute)
+        except FieldDoesNotExist:
+            return None
+
+        if allowed != '__all__' and field.name not in allowed:
+            return None
+
+        # Relations and uniqueness checks need the database, leave those
+        # to the ModelForm.
+        if field.is_relation or field.unique or not field.concrete or not field.editable:
+            return None
+        for unique_together in obj._meta.unique_together:
+            if field.name in unique_together:
+                return None
+        for other in obj._meta.concrete_fields:
+            for date_field in (other.unique_for_date, other.unique_for_month,
+                               other.unique_for_year):
+                if date_field and field.name in (other.name, date_field):
+                    return None
+        return field
+
+    def apply_fast(self, obj, field, save=True):
+        try:
+            value = field.clean(self.value, obj)
+        except ValidationError as e:
+            raise PatchException('Failed validation in field clean: {0}'.format(
+                {field.name: e.messages}))
+
+        old_values = self.get_field_values(obj, [field.name])
+        setattr(obj, field.attname, value)
+        if save:
+            self.save_object(
+                obj, [field.name], update_fields=[field.attname], old_values=old_values)
+            self.patch.reset_counts()
+            self.add_inverse('replace', self.get_inverse_path(), value=old_values[field.name])
+        return obj
+
+    def apply_document(self, obj, attribute, save=True):
+        old = self.get_document_snapshot()
+        if isinstance(obj, dict):
+            if attribute not in obj:
+                raise PatchException('Key does not exist: {0}'.format(attribute))
+            key = attribute
+        else:
+            key = self.get_document_index(obj, attribute)
+        if save:
+            self.add_inverse('replace', self.get_inverse_path(), value=copy.deepcopy(obj[key]))
+        obj[key] = self.value
+
+        if self.pointer.document is not None:
+            self.save_document(
+                save=save,
+                expression='jsonb_set({column}, %s, %s::jsonb)',
+                params=[self.get_document_path(attribute), self.dump_document_value(self.value)],
+                old=old)
+        return obj
+
 
 class AddOperation(PatchOperation):
     """
@@ -86,18 +420,44 @@ class AddOperation(PatchOperation):
     def apply(self, obj, save=True):
         obj, attribute = self.pointer.to_last(obj)
 
-        if attribute:
+        if self.in_document(obj):
+            return self.apply_document(obj, attribute, save=save)
+
+        if self.pointer.relation is not None:
+            return self.apply_relation(obj, save=save)
+
+        name = self.get_relation_name(obj, attribute)
+        if name is not None:
+            # The relation exists, so adding to it replaces its members
+            return self.set_relation(obj, name, save=save)
+
+        queryset = obj if isinstance(obj, QuerySet) else None
+        pk = None
+        if queryset is not None and attribute and attribute.startswith('pk:'):
+            # Recreate a row with the given pk, as inverse patches do for the
+            # rows they re-add
+            model = queryset.model
+            pk = self.get_related_pk(model, attribute[len('pk:'):])
+            using = self.patch.get_write_db(model) or router.db_for_write(model)
+            if model._base_manager.using(using).filter(pk=pk).exists():
+                raise PatchException('Entry exists at key: {0}'.format(attribute))
+        elif attribute and attribute != '-' and isinstance(obj, (QuerySet, list)):
+            # Validate index does not already exist. "-" appends, so needs
+            # no lookup at all.
             try:
-                # Validate index does not already exist
-                obj[int(attribute)]
-            except IndexError:
-                pass
-            else:
+                index = int(attribute)
+            except ValueError:
+                raise PatchException('Index is not an int: {0}'.format(attribute))
+            count = len(obj) if isinstance(obj, list) else self.patch.get_count(obj)
+            if index < count:
                 raise PatchException('Entry exists at position: {0}'.format(attribute))
 
-        if isinstance(obj, QuerySet):
+        if queryset is not None:
             model = obj.model
             obj = model()
+            obj.pk = pk
+        created = obj._state.adding
+        old_data = None if created else self.get_object_data(obj)
 
         form_kwargs = {
             'data': self.value
@@ -106,11 +466,54 @@ class AddOperation(PatchOperation):
         form = self.get_form(obj, form_kwargs=form_kwargs)
         if form.is_valid():
             if save:
-                form.save()
+                obj = self.save_form(form)
+                self.patch.reset_counts(added_to=queryset)
+                if queryset is not None:
+                    self.add_inverse('remove', self.get_sibling_path('pk:{0}'.format(obj.pk)))
+                elif created:
+                    self.add_inverse('remove', self.get_inverse_path())
+                else:
+                    self.add_inverse('add', self.get_inverse_path(), value=old_data)
         else:
             raise PatchException('Failed validation in form save: {0}'.format(form.errors))
         return obj
 
+    def apply_relation(self, obj, save=True):
+        # Many to many relations are unordered, the index is ignored
+        instance, name = self.pointer.relation
+        pk = self.get_related_pk(obj.model, self.value)
+        if save:
+            self.patch.queue_relation_change(instance, name, add=[pk])
+            self.add_inverse('remove', self.get_sibling_path('pk:{0}'.format(pk)))
+        return instance
+
+    def apply_document(self, obj, attribute, save=True):
+        old = self.get_document_snapshot()
+        if isinstance(obj, dict):
+            if save:
+                if attribute in obj:
+                    self.add_inverse(
+                        'replace', self.get_inverse_path(), value=copy.deepcopy(obj[attribute]))
+                else:
+                    self.add_inverse('remove', self.get_inverse_path())
+            obj[attribute] = self.value
+            expression = 'jsonb_set({column}, %s, %s::jsonb)'
+            path = attribute
+        else:
+            path = self.get_document_index(obj, attribute, insert=True)
+            obj.insert(path, self.value)
+            expression = 'jsonb_insert({column}, %s, %s::jsonb)'
+            if save:
+                self.add_inverse('remove', self.get_sibling_path(path))
+
+        if self.pointer.document is not None:
+            self.save_document(
+                save=save,
+                expression=expression,
+                params=[self.get_document_path(path), self.dump_document_value(self.value)],
+                old=old)
+        return obj
+
 
 class RemoveOperation(PatchOperation):
     """
@@ -122,22 +525,93 @@ class RemoveOperation(PatchOperation):
     def apply(self, obj, save=True):
         obj, attribute = self.pointer.to_last(obj)
 
+        if self.in_document(obj):
+            return self.apply_document(obj, attribute, save=save)
+
+        if self.pointer.relation is not None:
+            return self.apply_relation(obj, attribute, save=save)
+
+        name = self.get_relation_name(obj, attribute)
+        if name is not None:
+            # Removing the whole relation clears it
+            if save:
+                self.patch.flush_relation(obj, name)
+                self.add_inverse(
+                    'replace', self.get_inverse_path(), value=self.get_related_pks(obj, name))
+                self.patch.queue_relation_change(obj, name, replace=[])
+            return None
+
+        # Deleting may cascade to rows with queued relation changes
+        self.patch.flush_relations()
+
         if isinstance(obj, (QuerySet, list)):
             try:
-                item = obj[int(attribute)]
-            except IndexError:
-                raise PatchException('Index does not exist: {0}'.format(attribute))
-            except ValueError:
-                raise PatchException('Index is not an int: {0}'.format(attribute))
+                item = self.pointer.get_item(obj, attribute)
+            except PointerException as e:
+                raise PatchException(str(e))
             else:
-                item.delete()
+                if save:
+                    pk, data = item.pk, self.get_object_data(item)
+                    self.delete_object(item)
+                    self.patch.reset_counts()
+                    # Re-added with its pk, which earlier inverse operations use
+                    self.add_inverse('add', self.get_sibling_path('pk:{0}'.format(pk)), value=data)
                 if isinstance(obj, list):
                     # Special case for lists: Need to manually remove the item
-                    del obj[int(attribute)]
+                    obj.remove(item)
         else:
             # Re-use existing lookup logic here
             obj = self.pointer.resolve(obj)
-            obj.delete()
+            if save:
+                data = self.get_object_data(obj)
+                self.delete_object(obj)
+                self.patch.reset_counts()
+                self.add_inverse('add', self.get_inverse_path(), value=data)
+        return None
+
+    def get_lock_target(self, obj, attribute):
+        if (self.pointer.document is None and
+                self.pointer.relation is None and
+                isinstance(obj, (QuerySet, list))):
+            return self.pointer.get_item(obj, attribute)
+        return super(RemoveOperation, self).get_lock_target(obj, attribute)
+
+    def apply_relation(self, obj, attribute, save=True):
+        instance, name = self.pointer.relation
+        if attribute.startswith('pk:'):
+            # Unlinking by pk does not need to read the relation
+            pk = self.get_related_pk(obj.model, attribute[len('pk:'):])
+        else:
+            # Indexes are relative to the current state of the relation
+            self.pointer.flush_relation()
+            try:
+                pk = self.pointer.get_item(obj, attribute).pk
+            except PointerException as e:
+                raise PatchException(str(e))
+
+        if save:
+            self.patch.queue_relation_change(instance, name, remove=[pk])
+            self.add_inverse('add', self.get_sibling_path('-'), value=pk)
+        return None
+
+    def apply_document(self, obj, attribute, save=True):
+        old = self.get_document_snapshot()
+        if isinstance(obj, dict):
+            if attribute not in obj:
+                raise PatchException('Key does not exist: {0}'.format(attribute))
+            path = attribute
+        else:
+            path = self.get_document_index(obj, attribute)
+        if save:
+            self.add_inverse('add', self.get_inverse_path(), value=obj[path])
+        del obj[path]
+
+        if self.pointer.document is not None:
+            self.save_document(
+                save=save,
+                expression='{column} #- %s',
+                params=[self.get_document_path(path)],
+                old=old)
         return None
 
 
@@ -177,9 +651,48 @@ class TestOperation(PatchOperation):
     { "op": "test", "path": "/a/b/c", "value": "foo" }
     """
 
+    def get_lock_targets(self, obj):
+        return []
+
     def apply(self, obj, save=True):
         obj = self.pointer.resolve(obj)
 
-        if obj != self.value:
+        if isinstance(obj, QuerySet):
+            if not self.matches_queryset(obj):
+                raise PatchException('Collection does not match: {0}'.format(self.path))
+        elif obj != self.value:
             raise PatchException('Value does not match: Expected {0}, got {1}'.format(
                 obj, self.value))
+
+    def matches_queryset(self, queryset):
+        """
+        Compare a collection with the expected list, either of pks or of
+        objects with the field values to compare. Only the compared columns
+        are read, ``chunk_size`` rows at a time, stopping at the first
+        difference.
+        """
+        if not isinstance(self.value, (list, tuple)):
+            return False
+        queryset = self.pointer.get_ordered(queryset)
+        if queryset.count() != len(self.value):
+            return False
+
+        if all(isinstance(item, dict) for item in self.value):
+            names = set()
+            for item in self.value:
+                names.update(item)
+            try:
+                rows = queryset.values(*names)
+                rows = iterate(rows, self.patch.chunk_size)
+                for row, item in zip(rows, self.value):
+                    if any(row[name] != value for name, value in item.items()):
+                        return False
+            except FieldError:
+                return False
+            return True
+
+        rows = iterate(queryset.values_list('pk', flat=True), self.patch.chunk_size)
+        for pk, item in zip(rows, self.value):
+            if pk != item:
+                return False
+        return True
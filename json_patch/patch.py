@@ -1,12 +1,45 @@
-from .operations import (
-    AddOperation,
-    CopyOperation,
-    MoveOperation,
-    RemoveOperation,
-    ReplaceOperation,
-    TestOperation
-)
-from .exceptions import PatchException
+import hashlib
+import json
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.db import DEFAULT_DB_ALIAS, connections, router, transaction
+from django.utils import six
+from django.utils.module_loading import import_string
+
+from .changes import Change, ChangeSet
+from .exceptions import PatchException, PatchValidationError
+from .pointers import Pointer
+from .signals import patch_applied
+from .utils import lazy_import
+
+# Moved to django.core.exceptions in Django 1.11
+get_empty_result_set_class = lazy_import(
+    'EmptyResultSet', 'django.core.exceptions', 'django.db.models.sql.datastructures')
+
+# Cached while a patch sent with an idempotency key is being applied
+IDEMPOTENCY_PENDING = 'json_patch.pending'
+
+
+@contextmanager
+def no_transaction():
+    yield
+
+
+def encode_value(value):
+    """
+    Encode values of a patch document ``json.dumps`` does not handle, such as
+    model instances, which are encoded by model and pk.
+    """
+    from django.core.serializers.json import DjangoJSONEncoder
+
+    if hasattr(value, '_meta') and hasattr(value, 'pk'):
+        return '{0}:{1}'.format(value._meta.label_lower, value.pk)
+    try:
+        return DjangoJSONEncoder().default(value)
+    except TypeError:
+        return six.text_type(value)
 
 
 class Patch(object):
@@ -17,21 +50,128 @@ class Patch(object):
     The "application/json-patch+json" media type is used to identify such
     patch documents.
     """
+    # Operation classes, or dotted paths to them imported on first use so
+    # parsing and validating patches does not load forms or the ORM. "move"
+    # and "copy" are not implemented, so are reported as unsupported.
     operation_types = {
-        'add': AddOperation,
-        'copy': CopyOperation,
-        'move': MoveOperation,
-        'remove': RemoveOperation,
-        'replace': ReplaceOperation,
-        'test': TestOperation,
+        'add': 'json_patch.operations.AddOperation',
+        'remove': 'json_patch.operations.RemoveOperation',
+        'replace': 'json_patch.operations.ReplaceOperation',
+        'test': 'json_patch.operations.TestOperation',
+    }
+
+    # Members each operation type requires besides "op" and "path"
+    operation_members = {
+        'add': ('value', ),
+        'copy': ('from', ),
+        'move': ('from', ),
+        'remove': (),
+        'replace': ('value', ),
+        'test': ('value', ),
     }
 
-    def __init__(self, patch):
+    # Fields validated by calling ``clean()`` on the model field directly
+    # rather than through a ModelForm. Maps model class to a list of field
+    # names, or '__all__' for every simple field on the model.
+    fast_fields = {}
+
+    # Send only the changed part of jsonb documents on PostgreSQL, using
+    # ``jsonb_set`` / ``#-`` instead of saving the whole field.
+    json_partial_updates = False
+
+    # Ordering used when resolving indexes into querysets, mapping model class
+    # to a list of fields. Querysets of other models without an ordering are
+    # ordered by pk so indexes are stable.
+    ordering = {}
+
+    # Send pre/post save and delete signals for each row written. When False
+    # rows are written without them, and receivers of ``patch_applied`` are
+    # left to handle the whole change set at once. Rows are then written with
+    # ``_save_table()`` and ``sql.DeleteQuery`` directly, so overridden
+    # ``Model.save()`` and ``Model.delete()`` methods are not called either.
+    model_signals = True
+
+    # Databases written to and read from by the current call to ``apply``,
+    # None leaving the choice to the database routers. These are arguments
+    # to ``apply``, not options.
+    using = None
+    read_using = None
+    lock = False
+
+    # Apply the patch in a transaction, so it is applied in full or not at
+    # all. Always set on inverse patches.
+    atomic = False
+
+    # Number of rows loaded at a time when iterating over large collections
+    chunk_size = 500
+
+    # Cache storing the change sets of patches applied with an idempotency
+    # key, and the number of seconds they are kept
+    idempotency_cache = 'default'
+    idempotency_timeout = 24 * 60 * 60
+    # Seconds a patch being applied holds its key, so retries are not blocked
+    # for long by a worker that died while applying it
+    idempotency_pending_timeout = 60
+
+    def __init__(self, patch, **options):
         self.patch = patch
+        self.options = options
+        for key, value in options.items():
+            if not hasattr(self.__class__, key) or key in ('using', 'read_using', 'lock'):
+                # Databases and locking are chosen by each call to ``apply``
+                raise TypeError('Patch() received an invalid keyword {0!r}'.format(key))
+            setattr(self, key, value)
+        self.reset()
 
     def get_operations(self):
+        self.validate()
         return [self.get_operation(operation) for operation in self.patch]
 
+    def validate(self):
+        """
+        Check the structure of the whole patch document before anything is
+        resolved, raising PatchValidationError with every problem found.
+        """
+        errors = self.get_errors()
+        if errors:
+            raise PatchValidationError(errors)
+
+    def get_errors(self):
+        if not isinstance(self.patch, (list, tuple)):
+            return ['Patch should be a list of operations']
+
+        errors = []
+        operation_types = self.operation_types
+        operation_members = self.operation_members
+        is_pointer = Pointer.is_valid
+        string_types = six.string_types
+
+        for index, operation in enumerate(self.patch):
+            if not isinstance(operation, dict):
+                errors.append('{0}: Operation should be an object'.format(index))
+                continue
+
+            op = operation.get('op')
+            members = ()
+            if op is None:
+                errors.append('{0}: Missing operation type'.format(index))
+            elif not isinstance(op, string_types) or op not in operation_types:
+                errors.append('{0}: Unsupported operation: {1}'.format(index, op))
+            else:
+                members = operation_members.get(op, ())
+
+            if 'path' not in operation:
+                errors.append('{0}: Missing operation path'.format(index))
+            elif not is_pointer(operation['path']):
+                errors.append('{0}: Invalid path: {1!r}'.format(index, operation['path']))
+
+            for member in members:
+                if member not in operation:
+                    errors.append('{0}: Missing operation {1}'.format(index, member))
+                elif member == 'from' and not is_pointer(operation[member]):
+                    errors.append('{0}: Invalid from: {1!r}'.format(index, operation[member]))
+        return errors
+
     def get_operation(self, operation):
         if 'op' not in operation:
             raise PatchException('Missing operation type')
@@ -44,9 +184,399 @@ class Patch(object):
     def get_operation_class(self, op):
         if op not in self.operation_types:
             raise PatchException('Unsupported operation: {0}'.format(op))
-        return self.operation_types[op]
+        operation_class = self.operation_types[op]
+        if isinstance(operation_class, six.string_types):
+            operation_class = import_string(operation_class)
+        return operation_class
+
+    def get_count(self, queryset):
+        """
+        Return the number of items in ``queryset``. The count is cached until
+        the patch writes something that could change it.
+        """
+        key = self.get_count_key(queryset)
+        if key not in self.counts:
+            self.counts[key] = queryset.count()
+        return self.counts[key]
+
+    def get_count_key(self, queryset):
+        try:
+            sql = str(queryset.query)
+        except get_empty_result_set_class():
+            sql = None
+        return (queryset.db, queryset.model, sql)
+
+    def reset_counts(self, added_to=None):
+        """
+        Forget cached counts after a write. When a single item has been added
+        to ``added_to`` its count is kept, incremented by one.
+        """
+        count = None
+        if added_to is not None:
+            count = self.counts.get(self.get_count_key(added_to))
+        self.counts = {}
+        if count is not None:
+            self.counts[self.get_count_key(added_to)] = count + 1
+
+    def queue_relation_change(self, instance, name, add=(), remove=(), replace=None):
+        """
+        Queue a change to the many to many relation ``name`` on ``instance``.
+        Runs of changes to a relation are combined and written with a single
+        ``add()``, ``remove()`` or ``set()`` when the relation is next read,
+        or once the patch has been applied.
+        """
+        key = (instance.__class__, instance.pk, name)
+        if key not in self.relation_changes:
+            self.relation_changes[key] = {
+                'instance': instance,
+                'add': OrderedDict(),
+                'remove': OrderedDict(),
+                'replace': None,
+            }
+        changes = self.relation_changes[key]
+
+        if replace is not None:
+            changes['add'].clear()
+            changes['remove'].clear()
+            changes['replace'] = OrderedDict((pk, None) for pk in replace)
+
+        for pk in add:
+            if changes['replace'] is not None:
+                changes['replace'][pk] = None
+            else:
+                changes['remove'].pop(pk, None)
+                changes['add'][pk] = None
+
+        for pk in remove:
+            if changes['replace'] is not None:
+                changes['replace'].pop(pk, None)
+            else:
+                changes['add'].pop(pk, None)
+                changes['remove'][pk] = None
+
+    def flush_relation(self, instance, name):
+        key = (instance.__class__, instance.pk, name)
+        changes = self.relation_changes.pop(key, None)
+        if changes is None:
+            return
+
+        instance = changes['instance']
+        using = self.get_write_db(instance.__class__)
+        if using:
+            # Related managers write to the database of their instance, which
+            # may be the one it was read from
+            instance._state.db = using
+        manager = getattr(instance, name)
+        if changes['replace'] is not None:
+            manager.set(list(changes['replace']))
+        else:
+            if changes['remove']:
+                manager.remove(*changes['remove'])
+            if changes['add']:
+                manager.add(*changes['add'])
+        self.changes.record_updated(key[0], key[1], {name: (None, None)})
+        self.reset_counts()
 
-    def apply(self, obj, save=True):
-        for operation in self.get_operations():
-            operation.apply(obj)
+    def flush_relations(self):
+        while self.relation_changes:
+            key, changes = next(iter(self.relation_changes.items()))
+            self.flush_relation(changes['instance'], key[2])
+
+    def get_inverse(self):
+        """
+        Return a patch reverting the last call to ``apply``, built from the
+        values read while applying it.
+        """
+        options = dict(self.options, atomic=True)
+        return self.__class__(list(reversed(self.inverse_operations)), **options)
+
+    @contextmanager
+    def read_snapshot(self, using):
+        """
+        Run the enclosed reads in one transaction on ``using``, with
+        repeatable read isolation on PostgreSQL so they all see the same
+        snapshot.
+        """
+        connection = connections[using or DEFAULT_DB_ALIAS]
+        in_transaction = connection.in_atomic_block
+        with transaction.atomic(using=using):
+            if not in_transaction and connection.vendor == 'postgresql':
+                with connection.cursor() as cursor:
+                    cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+            yield
+
+    def get_lock_targets(self, obj, operations):
+        """
+        Return the existing rows ``operations`` will write, as an OrderedDict
+        of model to an OrderedDict of pk to the instances loaded for the row,
+        models and pks in a fixed order.
+        """
+        targets = {}
+        for operation in operations:
+            for instance in operation.get_lock_targets(obj):
+                instances = targets.setdefault(instance.__class__, {}).setdefault(instance.pk, [])
+                if not any(loaded is instance for loaded in instances):
+                    instances.append(instance)
+
+        return OrderedDict(
+            (model, OrderedDict(sorted(targets[model].items())))
+            for model in sorted(
+                targets, key=lambda model: (model._meta.app_label, model._meta.model_name))
+        )
+
+    def lock_targets(self, obj, operations):
+        """
+        Lock the rows ``operations`` will write with one ``select_for_update``
+        query per model. Rows are always locked in the same order so
+        concurrent patches wait on each other rather than deadlock.
+
+        Instances loaded while finding the rows are then refreshed, so the
+        patch is applied to what was committed before the lock was taken.
+        """
+        for model, instances in self.get_lock_targets(obj, operations).items():
+            using = self.get_write_db(model) or router.db_for_write(model)
+            if connections[using].features.has_select_for_update:
+                queryset = model._base_manager.using(using).select_for_update()
+                list(queryset.filter(pk__in=list(instances)).order_by('pk').values_list(
+                    'pk', flat=True))
+
+            for loaded in instances.values():
+                for instance in loaded:
+                    instance.refresh_from_db(using=using)
+
+    def get_write_db(self, model):
+        """
+        Return the database rows of ``model`` are written to, or None to let
+        the routers choose from the instance. When only ``read_using`` is set
+        the routers are asked without an instance, which would send the write
+        back to the database the instance was read from.
+        """
+        if self.using:
+            return self.using
+        if self.read_using:
+            return router.db_for_write(model)
+        return None
+
+    def apply(self, obj, save=True, using=None, read_using=None, snapshot=False, lock=False,
+              idempotency_key=None):
+        """
+        Apply the patch to ``obj``, returning a :class:`ChangeSet` of the
+        rows and fields written.
+
+        Writes go to the ``using`` database, while pointers are resolved and
+        ``test`` operations run against ``read_using``, e.g. a replica. With
+        ``snapshot`` those reads share a single transaction. With ``lock``
+        the patch runs in a transaction on ``using``, and the rows it writes
+        are locked before any operation is applied.
+
+        ``idempotency_key`` is a token sent by the client with every retry of
+        a request. The change set is then cached for ``idempotency_timeout``
+        seconds, and retries of the same patch to the same target with the
+        same key return it without touching the database. It is ignored when
+        ``save`` is False.
+        """
+        if idempotency_key is not None and save:
+            return self.apply_once(
+                idempotency_key, obj, save=save, using=using, read_using=read_using,
+                snapshot=snapshot, lock=lock)
+
+        self.using = using
+        self.read_using = read_using
+        self.lock = lock
+
+        read_context = self.read_snapshot(read_using) if snapshot else no_transaction()
+        write_context = (
+            transaction.atomic(using=using) if lock or self.atomic else no_transaction())
+        with read_context, write_context:
+            self.reset()
+            self.apply_operations(obj, self.get_operations(), save=save)
+            self.changes.inverse = self.get_inverse()
+
+        self.send_patch_applied(obj)
+        return self.changes
+
+    def apply_once(self, token, obj, **kwargs):
+        """
+        Apply the patch unless it has already been applied with ``token``,
+        returning the cached change set in that case. Raises PatchException
+        while a request with the same token and patch is still running.
+        """
+        from django.core.cache import caches
+
+        cache = caches[self.idempotency_cache]
+        key = self.get_idempotency_key(
+            token, obj, using=kwargs.get('using'), read_using=kwargs.get('read_using'))
+        for _ in range(3):
+            if cache.add(key, IDEMPOTENCY_PENDING, self.idempotency_pending_timeout):
+                break
+            changes = cache.get(key)
+            if changes == IDEMPOTENCY_PENDING:
+                raise PatchException('Patch is already being applied: {0}'.format(token))
+            if isinstance(changes, ChangeSet):
+                self.changes = changes
+                return changes
+            # The key expired since it was added, claim it again
+        else:
+            raise PatchException('Could not claim idempotency key: {0}'.format(token))
+
+        try:
+            changes = self.apply(obj, **kwargs)
+        except Exception:
+            # Let the client retry a patch that failed
+            cache.delete(key)
+            raise
+        cache.set(key, changes, self.idempotency_timeout)
+        return changes
+
+    def get_idempotency_key(self, token, obj, using=None, read_using=None):
+        """
+        Return the cache key for this patch applied to ``obj`` with ``token``,
+        hashing both so any token can be used with any cache backend.
+        """
+        document = json.dumps(
+            [self.patch, self.get_target_key(obj), using, read_using],
+            sort_keys=True, default=encode_value)
+        token = hashlib.sha1(six.text_type(token).encode('utf-8')).hexdigest()
+        digest = hashlib.sha1(document.encode('utf-8')).hexdigest()
+        return 'json_patch:{0}:{1}'.format(token, digest)
+
+    def get_target_key(self, obj):
+        """
+        Describe what the patch is applied to: a model instance by model and
+        pk, a queryset by its database, model and query.
+        """
+        if isinstance(obj, (list, tuple)):
+            return [self.get_target_key(item) for item in obj]
+        if hasattr(obj, '_meta'):
+            return encode_value(obj)
+        if hasattr(obj, 'query') and hasattr(obj, 'model'):
+            db, model, sql = self.get_count_key(obj)
+            return [db, model._meta.label_lower, sql]
         return obj
+
+    def apply_many(self, queryset, using=None):
+        """
+        Apply the patch to every instance in ``queryset``, paths being
+        relative to each instance, returning a single :class:`ChangeSet`.
+
+        The patch is validated once. When it only replaces simple fields with
+        constant values, it runs as a single ``update()`` (without per row
+        signals, so only when there are no ``pre_save`` / ``post_save``
+        receivers or ``model_signals`` is off). Otherwise instances are
+        loaded ``chunk_size`` at a time and patched in turn. Everything runs
+        in one transaction on ``using``. No inverse patch is built.
+        """
+        self.using = using
+        self.read_using = None
+        self.lock = False
+        self.reset()
+        self.inverse_operations = None
+
+        operations = self.get_operations()
+        values = self.get_update_values(queryset.model, operations)
+
+        if not queryset.query.can_filter():
+            # Sliced querysets can not be updated, filtered or reordered
+            pks = list(queryset.values_list('pk', flat=True))
+            queryset = queryset.model._base_manager.using(queryset.db).filter(pk__in=pks)
+
+        with transaction.atomic(using=using or router.db_for_write(queryset.model)):
+            if values is not None:
+                self.update_many(queryset, values)
+            else:
+                for instances in self.get_chunks(queryset):
+                    for instance in instances:
+                        self.apply_operations(instance, operations)
+
+        self.send_patch_applied(queryset)
+        return self.changes
+
+    def get_update_values(self, model, operations):
+        """
+        Return an OrderedDict of field to cleaned value when ``operations``
+        only replace simple fields of ``model``, so they can be applied to
+        many rows with one ``update()``. Returns None otherwise.
+        """
+        from django.db.models.signals import post_save, pre_save
+
+        if self.model_signals and (
+                pre_save.has_listeners(model) or post_save.has_listeners(model)):
+            return None
+        if any(getattr(field, 'auto_now', False) for field in model._meta.concrete_fields):
+            # update() would not refresh these
+            return None
+
+        values = OrderedDict()
+        for operation in operations:
+            replace = isinstance(operation, self.get_operation_class('replace'))
+            if not replace or len(operation.pointer.parts) != 1:
+                return None
+            try:
+                field = model._meta.get_field(operation.pointer.parts[0])
+            except FieldDoesNotExist:
+                return None
+            if (not field.concrete or field.many_to_many or field.primary_key or
+                    field.unique or not field.editable):
+                return None
+            for unique_together in model._meta.unique_together:
+                if field.name in unique_together:
+                    return None
+
+            try:
+                values[field] = field.clean(operation.value, model())
+            except ValidationError as e:
+                raise PatchException('Failed validation in field clean: {0}'.format(
+                    {field.name: e.messages}))
+        return values
+
+    def update_many(self, queryset, values):
+        from .db import iterate
+
+        fields = list(values)
+        rows = queryset.using(self.using).values_list('pk', *[field.attname for field in fields])
+        for row in iterate(rows, self.chunk_size):
+            self.changes.record_updated(queryset.model, row[0], dict(
+                (field.name, (old, values[field])) for field, old in zip(fields, row[1:])))
+
+        queryset.using(self.using).update(
+            **dict((field.attname, value) for field, value in values.items()))
+
+    def get_chunks(self, queryset):
+        """
+        Yield the instances in ``queryset`` in lists of ``chunk_size``,
+        paging on pk so memory use does not grow with the queryset.
+        """
+        queryset = queryset.order_by('pk')
+        instances = list(queryset[:self.chunk_size])
+        while instances:
+            yield instances
+            instances = list(queryset.filter(pk__gt=instances[-1].pk)[:self.chunk_size])
+
+    def reset(self):
+        # Many to many changes waiting to be written, keyed on the relation
+        self.relation_changes = OrderedDict()
+        # Cached collection sizes, keyed on the query
+        self.counts = {}
+        self.changes = ChangeSet()
+        # Operations undoing the ones applied, in the order they were applied,
+        # or None when they are not collected
+        self.inverse_operations = []
+
+    def apply_operations(self, obj, operations, save=True):
+        if self.lock:
+            self.lock_targets(obj, operations)
+
+        for operation in operations:
+            operation.apply(obj, save=save)
+        self.flush_relations()
+
+    def send_patch_applied(self, obj):
+        if self.changes:
+            patch_applied.send(
+                sender=self.__class__,
+                patch=self,
+                obj=obj,
+                changes=self.changes,
+                created=self.changes.get_triples(Change.CREATED),
+                updated=self.changes.get_triples(Change.UPDATED),
+                deleted=self.changes.get_triples(Change.DELETED))
@@ -1,7 +1,16 @@
-from django.core.exceptions import FieldDoesNotExist
-from django.db.models import ManyToOneRel, QuerySet
+import re
+
+from django.core.exceptions import FieldDoesNotExist, ObjectDoesNotExist, ValidationError
+from django.utils import six
 
 from .exceptions import PointerException
+from .utils import lazy_import
+
+get_queryset_class = lazy_import('QuerySet', 'django.db.models')
+get_many_to_one_rel_class = lazy_import('ManyToOneRel', 'django.db.models')
+
+# Zero or more "/" prefixed reference tokens, "~" only escaping "~0" / "~1"
+POINTER_RE = re.compile(r'^(/([^~/]|~[01])*)*$')
 
 
 class Pointer(object):
@@ -10,35 +19,86 @@ class Pointer(object):
     within a JavaScript Object Notation (JSON) document.
     """
 
-    def __init__(self, path):
+    def __init__(self, path, flush=None, ordering=None, using=None):
         self.path = path
+        # Database the pointer is resolved against, rather than the one the
+        # routers pick for reads
+        self.using = using
+        # Maps model class to the ordering used when indexing its querysets.
+        # Querysets without an ordering are otherwise ordered by pk.
+        self.ordering = ordering or {}
+        # Called with (instance, name) before reading a many to many relation,
+        # so changes queued against it by earlier operations are written.
+        self.flush = flush
+        # When the pointer steps into a JSON valued model field this is set to
+        # (instance, field, parts), parts being the path within the document.
+        self.document = None
+        # When the pointer steps into a many to many relation this is set to
+        # (instance, name) of the relation manager.
+        self.relation = None
+        # Parts resolved so far, with indexes of rows replaced by "pk:<pk>"
+        self.keyed_parts = []
+
+    @classmethod
+    def is_valid(cls, path):
+        return isinstance(path, six.string_types) and POINTER_RE.match(path) is not None
+
+    @staticmethod
+    def escape(part):
+        """
+        Escape ``part`` for use as a reference token, reversing ``parts``.
+        """
+        return six.text_type(part).replace('~', '~0').replace('/', '~1')
 
     @property
     def parts(self):
         path_list = self.path.lstrip('/').split('/')
-        return [path for path in path_list if path != '']
+        return [
+            path.replace('~1', '/').replace('~0', '~')
+            for path in path_list if path != ''
+        ]
 
     def resolve(self, obj):
+        self.document = None
+        self.relation = None
+        self.keyed_parts = []
+        obj = self.get_queryset(obj)
         for part in self.parts:
+            self.keyed_parts.append(part)
             obj = self.process_part(obj, part)
+        self.flush_relation()
         return obj
 
     def to_last(self, obj):
+        self.document = None
+        self.relation = None
+        self.keyed_parts = []
+        obj = self.get_queryset(obj)
         if not self.parts:
             return obj, None
         for part in self.parts[:-1]:
+            self.keyed_parts.append(part)
             obj = self.process_part(obj, part)
         return obj, self.parts[-1]
 
     def process_part(self, obj, part):
+        QuerySet = get_queryset_class()
+
+        if self.document is not None:
+            # Walk inside a decoded JSON document
+            self.document[2].append(part)
+            return self.process_document_part(obj, part)
+
+        if isinstance(obj, dict):
+            return self.process_document_part(obj, part)
+
         if isinstance(obj, (QuerySet, list)):
-            # Get item from queryset / list
-            try:
-                obj = obj[int(part)]
-            except IndexError:
-                raise PointerException('Index does not exist: {0}'.format(part))
-            except ValueError:
-                raise PointerException('Index is not an int: {0}'.format(part))
+            self.flush_relation()
+            self.relation = None
+            obj = self.get_item(obj, part)
+            if hasattr(obj, '_meta'):
+                # Indexes shift as rows are added and removed, keys do not
+                self.keyed_parts[-1] = 'pk:{0}'.format(obj.pk)
         else:
             # Navigate relationship
             if not hasattr(obj, '_meta'):
@@ -50,8 +110,119 @@ class Pointer(object):
             except FieldDoesNotExist:
                 field = None
 
-            if isinstance(field, ManyToOneRel):
-                obj = getattr(obj, part).all()
+            if isinstance(field, get_many_to_one_rel_class()):
+                obj = self.get_queryset(getattr(obj, part).all())
+            elif field is not None and field.many_to_many:
+                self.relation = (obj, part)
+                obj = self.get_queryset(getattr(obj, part).all())
+            elif self.using and field is not None and field.concrete and field.is_relation:
+                obj = self.get_related(obj, field)
             else:
-                obj = getattr(obj, part)
+                value = getattr(obj, part)
+                if field is not None and field.concrete and not field.is_relation:
+                    self.document = (obj, field, [])
+                obj = value
+        return obj
+
+    def get_queryset(self, obj):
+        QuerySet = get_queryset_class()
+
+        if self.using and isinstance(obj, QuerySet):
+            return obj.using(self.using)
         return obj
+
+    def get_related(self, obj, field):
+        value = getattr(obj, field.attname)
+        if value is None:
+            return None
+        try:
+            return field.related_model._base_manager.using(self.using).get(
+                **{field.target_field.attname: value})
+        except ObjectDoesNotExist:
+            raise PointerException('Related object does not exist: {0}'.format(field.name))
+
+    def get_item(self, obj, part):
+        """
+        Get an item from a queryset or list, either by index or by a unique
+        key written as ``<field>:<value>``, e.g. ``pk:42``.
+        """
+        QuerySet = get_queryset_class()
+
+        if ':' in part:
+            return self.get_item_by_key(obj, part)
+        if part == '-':
+            # "-" refers to the position after the last item
+            raise PointerException('Index does not exist: {0}'.format(part))
+        if isinstance(obj, QuerySet):
+            obj = self.get_ordered(obj)
+        try:
+            return obj[int(part)]
+        except IndexError:
+            raise PointerException('Index does not exist: {0}'.format(part))
+        except ValueError:
+            raise PointerException('Index is not an int: {0}'.format(part))
+
+    def get_item_by_key(self, obj, part):
+        QuerySet = get_queryset_class()
+
+        name, value = part.split(':', 1)
+        if isinstance(obj, QuerySet):
+            model = obj.model
+        elif obj:
+            model = obj[0].__class__
+        else:
+            raise PointerException('Key does not exist: {0}'.format(part))
+
+        if name == 'pk':
+            field = model._meta.pk
+        else:
+            try:
+                field = model._meta.get_field(name)
+            except FieldDoesNotExist:
+                raise PointerException('Field does not exist: {0}'.format(name))
+            if not field.unique:
+                raise PointerException('Field is not unique: {0}'.format(name))
+
+        try:
+            value = field.to_python(value)
+        except ValidationError:
+            raise PointerException('Invalid key: {0}'.format(part))
+
+        if isinstance(obj, QuerySet):
+            try:
+                return obj.get(**{field.attname: value})
+            except ObjectDoesNotExist:
+                raise PointerException('Key does not exist: {0}'.format(part))
+
+        for item in obj:
+            if getattr(item, field.attname) == value:
+                return item
+        raise PointerException('Key does not exist: {0}'.format(part))
+
+    def get_ordered(self, queryset):
+        ordering = self.ordering.get(queryset.model)
+        if ordering:
+            return queryset.order_by(*ordering)
+        if not queryset.ordered:
+            return queryset.order_by('pk')
+        return queryset
+
+    def flush_relation(self):
+        if self.relation is not None and self.flush is not None:
+            self.flush(*self.relation)
+
+    def process_document_part(self, obj, part):
+        if isinstance(obj, dict):
+            try:
+                return obj[part]
+            except KeyError:
+                raise PointerException('Key does not exist: {0}'.format(part))
+        if isinstance(obj, list):
+            try:
+                return obj[int(part)]
+            except IndexError:
+                raise PointerException('Index does not exist: {0}'.format(part))
+            except ValueError:
+                raise PointerException('Index is not an int: {0}'.format(part))
+        raise PointerException('process_part: Expected a dict or list, got {0}'.format(
+            type(obj)))
@@ -0,0 +1,7 @@
+from django.dispatch import Signal
+
+# Sent once a patch has been applied, with the ``changes`` ChangeSet and
+# ``created``, ``updated`` and ``deleted`` lists of (model, pk, fields)
+# triples. Receivers can batch work such as cache invalidation here instead
+# of listening to per row signals.
+patch_applied = Signal()
@@ -0,0 +1,22 @@
+from importlib import import_module
+
+
+def lazy_import(name, *modules):
+    """
+    Return a function returning ``name`` from the first of ``modules`` that
+    defines it. The import happens on the first call, so modules using it
+    can be imported without loading forms or the ORM.
+    """
+    loaded = []
+
+    def load():
+        if not loaded:
+            for module in modules:
+                value = getattr(import_module(module), name, None)
+                if value is not None:
+                    loaded.append(value)
+                    break
+            else:
+                raise ImportError('Cannot import {0} from {1}'.format(name, ', '.join(modules)))
+        return loaded[0]
+    return load
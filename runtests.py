@@ -10,7 +10,10 @@ try:
         DATABASES={
             "default": {
                 "ENGINE": "django.db.backends.sqlite3",
-            }
+            },
+            "replica": {
+                "ENGINE": "django.db.backends.sqlite3",
+            },
         },
         ROOT_URLCONF="json_patch.urls",
         INSTALLED_APPS=[
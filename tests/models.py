@@ -1,10 +1,52 @@
+import json
+
 from django.db import models
+from django.utils import six
+
+
+class JSONField(models.TextField):
+    """
+    Minimal JSON field storing its value as text, for testing traversal into
+    decoded documents without requiring PostgreSQL.
+    """
+
+    def from_db_value(self, value, expression, connection, context):
+        return self.to_python(value)
+
+    def to_python(self, value):
+        if isinstance(value, six.string_types):
+            return json.loads(value)
+        return value
+
+    def get_prep_value(self, value):
+        return json.dumps(value)
 
 
 class Author(models.Model):
     name = models.CharField('Name', max_length=255)
 
 
+class Pseudonym(models.Model):
+    author = models.ForeignKey('Author', related_name='pseudonyms')
+    name = models.CharField('Name', max_length=255)
+
+
+class Tag(models.Model):
+    name = models.CharField('Name', max_length=255)
+
+
 class Book(models.Model):
     author = models.ForeignKey('Author', related_name='books')
     title = models.CharField('Title', max_length=255)
+    tags = models.ManyToManyField('Tag', related_name='books', blank=True)
+
+
+class Article(models.Model):
+    title = models.CharField('Title', max_length=255, unique_for_date='published')
+    published = models.DateField('Published')
+    body = models.TextField('Body', blank=True)
+
+
+class Publisher(models.Model):
+    name = models.CharField('Name', max_length=255)
+    data = JSONField('Data', default=dict)
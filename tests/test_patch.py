@@ -1,11 +1,24 @@
-from django.test import TestCase
+import datetime
+import json
+import os
+import subprocess
+import sys
 
-from json_patch.exceptions import PatchException, PointerException
+from django.core.cache import cache
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from json_patch.exceptions import PatchException, PatchValidationError, PointerException
 from json_patch.operations import AddOperation
-from json_patch.patch import Patch
+from json_patch.patch import IDEMPOTENCY_PENDING, Patch
+from json_patch.signals import patch_applied
 from tests.models import (
+    Article,
     Author,
     Book,
+    Pseudonym,
+    Publisher,
+    Tag,
 )
 
 
@@ -51,6 +64,66 @@ class TestPatch(TestCase):
         add_operation = patch.get_operation(operation)
         self.assertIsInstance(add_operation, AddOperation)
 
+    def test_all_validation_errors_are_reported(self):
+        invalid_diff = [
+            {'op': 'add', 'path': '/0'},
+            {'op': 'mock', 'path': '/0'},
+            {'op': 'move', 'path': '/0', 'from': '0'},
+            {'op': 'replace', 'path': 'name', 'value': 'Jeff'},
+            {'path': '/0/name', 'value': 'Jeff'},
+            'mock',
+            {'op': 'remove', 'path': '/0/name~2'},
+            {'op': 'test', 'path': '/0/name', 'value': 'Jeff'},
+        ]
+
+        patch = Patch(invalid_diff)
+        with self.assertNumQueries(0):
+            with self.assertRaises(PatchValidationError) as context:
+                patch.apply(Author.objects.all())
+
+        self.assertEqual(context.exception.errors, [
+            '0: Missing operation value',
+            '1: Unsupported operation: mock',
+            '2: Unsupported operation: move',
+            "3: Invalid path: 'name'",
+            '4: Missing operation type',
+            '5: Operation should be an object',
+            "6: Invalid path: '/0/name~2'",
+        ])
+
+    def test_move_and_copy_are_rejected_before_reading(self):
+        for op in ('move', 'copy'):
+            patch = Patch([{'op': op, 'path': '/1', 'from': '/0'}])
+            with self.assertNumQueries(0):
+                with self.assertRaises(PatchValidationError) as context:
+                    patch.apply(Author.objects.all())
+            self.assertEqual(context.exception.errors, ['0: Unsupported operation: ' + op])
+
+    def test_validation_error_raised_when_patch_is_not_a_list(self):
+        patch = Patch({'op': 'remove', 'path': '/0'})
+        with self.assertRaises(PatchValidationError):
+            patch.validate()
+
+    def test_escaped_path_parts_are_decoded(self):
+        patch = Patch([])
+        operation = patch.get_operation({'op': 'remove', 'path': '/a~1b/c~0d'})
+        self.assertEqual(operation.pointer.parts, ['a/b', 'c~d'])
+
+    def test_nothing_is_written_without_save(self):
+        author = Author.objects.create(name='Bob')
+        Book.objects.create(author=author, title='Book One')
+
+        patch = Patch([
+            {'op': 'replace', 'path': '/0/name', 'value': 'Jeff'},
+            {'op': 'remove', 'path': '/0/books/0'},
+            {'op': 'add', 'path': '/-', 'value': {'name': 'Jane'}},
+        ])
+        changes = patch.apply(Author.objects.all(), save=False)
+
+        self.assertFalse(changes)
+        self.assertEqual(list(Author.objects.values_list('name', flat=True)), ['Bob'])
+        self.assertEqual(Book.objects.count(), 1)
+
 
 class TestPatchAddOperation(TestCase):
 
@@ -112,6 +185,62 @@ class TestPatchAddOperation(TestCase):
         books = Book.objects.filter(author=author).all()
         self.assertEqual(books[0].title, 'Book one')
 
+    def test_author_is_appended_without_counting(self):
+        Author.objects.create(name='Bob')
+
+        add_author_diff = [
+            {
+                'op': 'add',
+                'path': '/-',
+                'value': {
+                    'name': 'Jane'
+                }
+            }
+        ]
+
+        patch = Patch(add_author_diff)
+        authors = Author.objects.all()
+        with self.assertNumQueries(1):
+            patch.apply(authors)
+
+        self.assertEqual(Author.objects.count(), 2)
+
+    def test_authors_count_is_queried_once(self):
+        add_authors_diff = [
+            {
+                'op': 'add',
+                'path': '/{0}'.format(index),
+                'value': {
+                    'name': 'Author {0}'.format(index)
+                }
+            } for index in range(3)
+        ]
+
+        patch = Patch(add_authors_diff)
+        authors = Author.objects.all()
+        with self.assertNumQueries(4):
+            patch.apply(authors)
+
+        self.assertEqual(Author.objects.count(), 3)
+
+    def test_exception_thrown_when_adding_at_existing_index(self):
+        Author.objects.create(name='Bob')
+
+        add_author_diff = [
+            {
+                'op': 'add',
+                'path': '/0',
+                'value': {
+                    'name': 'Jane'
+                }
+            }
+        ]
+
+        patch = Patch(add_author_diff)
+        authors = Author.objects.all()
+        with self.assertRaises(PatchException):
+            patch.apply(authors)
+
     def test_exception_throw_when_adding_invalid_path(self):
         add_author_diff = [
             {
@@ -189,6 +318,117 @@ class TestPatchReplaceOperation(TestCase):
         books = Book.objects.filter(author=author).all()
         self.assertEqual(books[1].title, 'Book Two')
 
+    def test_author_name_is_replaced_with_fast_validation(self):
+        author = Author.objects.create(name='Bob')
+
+        update_author_diff = [
+            {
+                'op': 'replace',
+                'path': '/name',
+                'value': 'Jeff',
+            }
+        ]
+
+        patch = Patch(update_author_diff, fast_fields={Author: ['name']})
+        with self.assertNumQueries(1):
+            patch.apply(author)
+
+        author_lookup = Author.objects.get(pk=author.pk)
+        self.assertEqual(author_lookup.name, 'Jeff')
+
+    def test_exception_thrown_when_fast_validation_fails(self):
+        author = Author.objects.create(name='Bob')
+
+        update_author_diff = [
+            {
+                'op': 'replace',
+                'path': '/name',
+                'value': 'J' * 256,
+            }
+        ]
+
+        patch = Patch(update_author_diff, fast_fields={Author: '__all__'})
+        with self.assertRaises(PatchException):
+            patch.apply(author)
+
+        author_lookup = Author.objects.get(pk=author.pk)
+        self.assertEqual(author_lookup.name, 'Bob')
+
+    def test_unique_for_date_fields_are_validated_by_form(self):
+        article = Article(title='News', published=datetime.date(2016, 1, 1))
+        patch = Patch([
+            {'op': 'replace', 'path': '/{0}'.format(name), 'value': ''}
+            for name in ('title', 'published', 'body')
+        ], fast_fields={Article: '__all__'})
+
+        fields = [operation.get_fast_field(article, name) for operation, name in zip(
+            patch.get_operations(), ('title', 'published', 'body'))]
+        self.assertEqual(fields, [None, None, Article._meta.get_field('body')])
+
+
+class TestPatchKeyedPointers(TestCase):
+
+    def setUp(self):
+        self.bob = Author.objects.create(name='Bob')
+        self.jane = Author.objects.create(name='Jane')
+        self.book = Book.objects.create(author=self.jane, title='Book One')
+
+    def test_author_is_replaced_by_pk(self):
+        update_author_diff = [
+            {
+                'op': 'replace',
+                'path': '/pk:{0}/name'.format(self.jane.pk),
+                'value': 'Janet',
+            }
+        ]
+
+        patch = Patch(update_author_diff)
+        patch.apply(Author.objects.all())
+
+        self.assertEqual(Author.objects.get(pk=self.jane.pk).name, 'Janet')
+        self.assertEqual(Author.objects.get(pk=self.bob.pk).name, 'Bob')
+
+    def test_nested_book_is_removed_by_pk(self):
+        delete_book_diff = [
+            {
+                'op': 'remove',
+                'path': '/pk:{0}/books/pk:{1}'.format(self.jane.pk, self.book.pk),
+            }
+        ]
+
+        patch = Patch(delete_book_diff)
+        patch.apply(list(Author.objects.all()))
+
+        self.assertEqual(Book.objects.count(), 0)
+
+    def test_indexes_use_configured_ordering(self):
+        update_author_diff = [
+            {
+                'op': 'replace',
+                'path': '/0/name',
+                'value': 'Janet',
+            }
+        ]
+
+        patch = Patch(update_author_diff, ordering={Author: ['-name']})
+        patch.apply(Author.objects.all())
+
+        self.assertEqual(Author.objects.get(pk=self.jane.pk).name, 'Janet')
+
+    def test_exception_thrown_when_key_does_not_exist(self):
+        patch = Patch([
+            {'op': 'test', 'path': '/pk:999/name', 'value': 'Bob'}
+        ])
+        with self.assertRaises(PointerException):
+            patch.apply(Author.objects.all())
+
+    def test_exception_thrown_when_key_field_is_not_unique(self):
+        patch = Patch([
+            {'op': 'test', 'path': '/name:Bob/name', 'value': 'Bob'}
+        ])
+        with self.assertRaises(PointerException):
+            patch.apply(Author.objects.all())
+
 
 class TestPatchRemoveOperation(TestCase):
 
@@ -328,3 +568,746 @@ class TestPatchTestOperation(TestCase):
         authors = Author.objects.all()
         with self.assertRaises(PointerException):
             patch.apply(authors)
+
+    def test_collection_matches_field_values(self):
+        author = Author.objects.create(name='Jeff')
+        Book.objects.create(author=author, title='First')
+        Book.objects.create(author=author, title='Second')
+
+        patch = Patch([
+            {'op': 'test', 'path': '/0/books', 'value': [{'title': 'First'}, {'title': 'Second'}]},
+        ], chunk_size=1)
+        patch.apply(Author.objects.all())
+
+    def test_collection_matches_pks(self):
+        author = Author.objects.create(name='Jeff')
+        first = Book.objects.create(author=author, title='First')
+        second = Book.objects.create(author=author, title='Second')
+
+        patch = Patch([
+            {'op': 'test', 'path': '/0/books', 'value': [first.pk, second.pk]},
+        ])
+        patch.apply(Author.objects.all())
+
+    def test_exception_thrown_when_collection_does_not_match(self):
+        author = Author.objects.create(name='Jeff')
+        Book.objects.create(author=author, title='First')
+        Book.objects.create(author=author, title='Second')
+
+        for value in ([{'title': 'First'}, {'title': 'Third'}], [{'missing': 'First'}, {'missing': 'Second'}]):
+            patch = Patch([{'op': 'test', 'path': '/0/books', 'value': value}])
+            with self.assertRaises(PatchException):
+                patch.apply(Author.objects.all())
+
+    def test_collection_length_is_compared_before_reading_rows(self):
+        author = Author.objects.create(name='Jeff')
+        Book.objects.create(author=author, title='First')
+
+        patch = Patch([
+            {'op': 'test', 'path': '/0/books', 'value': [{'title': 'First'}, {'title': 'Second'}]},
+        ])
+        authors = list(Author.objects.all())
+        with self.assertNumQueries(1):
+            with self.assertRaises(PatchException):
+                patch.apply(authors)
+
+
+class TestPatchRelationOperations(TestCase):
+
+    def setUp(self):
+        author = Author.objects.create(name='Jeff')
+        self.book = Book.objects.create(author=author, title='Book One')
+        self.tags = [Tag.objects.create(name=name) for name in ('a', 'b', 'c')]
+
+    def get_tag_names(self):
+        return list(self.book.tags.order_by('name').values_list('name', flat=True))
+
+    def test_tags_are_added_in_one_insert(self):
+        add_tags_diff = [
+            {'op': 'add', 'path': '/tags/-', 'value': tag.pk} for tag in self.tags
+        ]
+
+        patch = Patch(add_tags_diff)
+        # One query for existing links, one bulk insert
+        with self.assertNumQueries(2):
+            patch.apply(self.book)
+
+        self.assertEqual(self.get_tag_names(), ['a', 'b', 'c'])
+
+    def test_adding_the_relation_replaces_its_members(self):
+        self.book.tags.add(self.tags[0])
+
+        patch = Patch([{'op': 'add', 'path': '/tags', 'value': [self.tags[1].pk, self.tags[2].pk]}])
+        changes = patch.apply(self.book)
+
+        self.assertEqual(self.get_tag_names(), ['b', 'c'])
+        changes.inverse.apply(self.book)
+        self.assertEqual(self.get_tag_names(), ['a'])
+
+    def test_tag_is_unlinked_not_deleted(self):
+        self.book.tags.add(*self.tags)
+
+        remove_tag_diff = [
+            {'op': 'remove', 'path': '/tags/0'},
+            {'op': 'remove', 'path': '/tags/0'},
+        ]
+
+        patch = Patch(remove_tag_diff)
+        patch.apply(self.book)
+
+        self.assertEqual(len(self.get_tag_names()), 1)
+        self.assertEqual(Tag.objects.count(), 3)
+
+    def test_tags_are_replaced(self):
+        self.book.tags.add(self.tags[0])
+
+        replace_tags_diff = [
+            {'op': 'replace', 'path': '/tags', 'value': [self.tags[1].pk, {'id': self.tags[2].pk}]},
+        ]
+
+        patch = Patch(replace_tags_diff)
+        patch.apply(self.book)
+
+        self.assertEqual(self.get_tag_names(), ['b', 'c'])
+
+    def test_queued_tags_are_written_before_being_read(self):
+        add_tag_diff = [
+            {'op': 'add', 'path': '/tags/-', 'value': self.tags[0].pk},
+            {'op': 'test', 'path': '/tags/0/name', 'value': 'a'},
+        ]
+
+        patch = Patch(add_tag_diff)
+        patch.apply(self.book)
+
+    def test_exception_thrown_when_related_pk_is_invalid(self):
+        patch = Patch([
+            {'op': 'add', 'path': '/tags/-', 'value': 'mock'}
+        ])
+        with self.assertRaises(PatchException):
+            patch.apply(self.book)
+
+
+class TestPatchChangeSet(TestCase):
+
+    def test_changed_fields_are_returned(self):
+        author = Author.objects.create(name='Bob')
+        book = Book.objects.create(author=author, title='Book One')
+
+        diff = [
+            {'op': 'replace', 'path': '/0/name', 'value': 'Jeff'},
+            {'op': 'replace', 'path': '/0/name', 'value': 'Jane'},
+            {'op': 'add', 'path': '/0/books/-', 'value': {'title': 'Book Two', 'author': author.pk}},
+            {'op': 'remove', 'path': '/0/books/0'},
+        ]
+
+        patch = Patch(diff)
+        changes = patch.apply(Author.objects.all())
+
+        self.assertEqual(len(changes), 3)
+        self.assertEqual(changes.get(Author, author.pk).fields, {'name': ('Bob', 'Jane')})
+
+        created, = changes.created
+        self.assertEqual(created.model, Book)
+        self.assertEqual(created.fields['title'], (None, 'Book Two'))
+
+        deleted, = changes.deleted
+        self.assertEqual((deleted.model, deleted.pk), (Book, book.pk))
+
+    def test_cascaded_fast_deletes_are_returned(self):
+        for model_signals in (True, False):
+            author = Author.objects.create(name='Bob')
+            pseudonym = Pseudonym.objects.create(author=author, name='Robert')
+
+            patch = Patch([{'op': 'remove', 'path': '/0'}], model_signals=model_signals)
+            changes = patch.apply(Author.objects.all())
+
+            self.assertEqual(
+                sorted((change.model.__name__, change.pk) for change in changes.deleted),
+                [('Author', author.pk), ('Pseudonym', pseudonym.pk)])
+
+    def test_overridden_delete_is_called(self):
+        Author.objects.create(name='Bob')
+        deleted = []
+
+        def delete(author, *args, **kwargs):
+            deleted.append(author.name)
+            return original(author, *args, **kwargs)
+
+        original = Author.delete
+        Author.delete = delete
+        self.addCleanup(setattr, Author, 'delete', original)
+
+        changes = Patch([{'op': 'remove', 'path': '/0'}]).apply(Author.objects.all())
+
+        self.assertEqual(deleted, ['Bob'])
+        self.assertEqual(len(changes.deleted), 1)
+
+    def test_changed_document_keeps_original_value(self):
+        publisher = Publisher.objects.create(name='Penguin', data={'city': 'London'})
+
+        diff = [
+            {'op': 'replace', 'path': '/data/city', 'value': 'Bath'},
+            {'op': 'add', 'path': '/data/country', 'value': 'UK'},
+        ]
+
+        patch = Patch(diff)
+        changes = patch.apply(publisher)
+
+        self.assertEqual(changes.get(Publisher, publisher.pk).fields, {
+            'data': ({'city': 'London'}, {'city': 'Bath', 'country': 'UK'})
+        })
+
+    def test_change_set_is_empty_when_nothing_changed(self):
+        Author.objects.create(name='Jeff')
+
+        patch = Patch([
+            {'op': 'test', 'path': '/0/name', 'value': 'Jeff'}
+        ])
+        changes = patch.apply(Author.objects.all())
+
+        self.assertFalse(changes)
+
+
+class TestPatchInverse(TestCase):
+
+    def test_inverse_reverts_model_changes(self):
+        author = Author.objects.create(name='Bob')
+        Book.objects.create(author=author, title='Book One')
+        Book.objects.create(author=author, title='Book Two')
+
+        diff = [
+            {'op': 'replace', 'path': '/0/name', 'value': 'Jeff'},
+            {'op': 'add', 'path': '/0/books/-', 'value': {'title': 'Book Three', 'author': author.pk}},
+            {'op': 'remove', 'path': '/0/books/0'},
+        ]
+
+        patch = Patch(diff)
+        changes = patch.apply(Author.objects.all())
+        changes.inverse.apply(Author.objects.all())
+
+        self.assertEqual(Author.objects.get().name, 'Bob')
+        self.assertEqual(
+            sorted(Book.objects.values_list('title', flat=True)), ['Book One', 'Book Two'])
+
+    def test_inverse_addresses_rows_by_pk(self):
+        a = Author.objects.create(name='A')
+        b = Author.objects.create(name='B')
+
+        diff = [
+            {'op': 'replace', 'path': '/1/name', 'value': 'B2'},
+            {'op': 'remove', 'path': '/0'},
+        ]
+
+        patch = Patch(diff)
+        changes = patch.apply(Author.objects.all())
+        changes.inverse.apply(Author.objects.all())
+
+        self.assertEqual(
+            list(Author.objects.order_by('pk').values_list('pk', 'name')),
+            [(a.pk, 'A'), (b.pk, 'B')])
+
+    def test_inverse_re_adds_removed_rows_with_their_pk(self):
+        author = Author.objects.create(name='A')
+
+        diff = [
+            {'op': 'replace', 'path': '/0/name', 'value': 'B'},
+            {'op': 'remove', 'path': '/0'},
+        ]
+
+        patch = Patch(diff)
+        changes = patch.apply(Author.objects.all())
+        changes.inverse.apply(Author.objects.all())
+
+        self.assertEqual(list(Author.objects.values_list('pk', 'name')), [(author.pk, 'A')])
+
+    def test_inverse_is_applied_atomically(self):
+        Author.objects.create(name='A')
+
+        patch = Patch([{'op': 'replace', 'path': '/0/name', 'value': 'B'}])
+        changes = patch.apply(Author.objects.all())
+        inverse = Patch(
+            changes.inverse.patch + [{'op': 'test', 'path': '/0/name', 'value': 'C'}],
+            **changes.inverse.options)
+
+        with self.assertRaises(PatchException):
+            inverse.apply(Author.objects.all())
+        self.assertEqual(Author.objects.get().name, 'B')
+
+    def test_inverse_of_add_to_instance(self):
+        author = Author()
+
+        patch = Patch([{'op': 'add', 'path': '/', 'value': {'name': 'A'}}])
+        changes = patch.apply(author)
+
+        self.assertEqual(changes.inverse.patch, [{'op': 'remove', 'path': '/'}])
+        changes.inverse.apply(author)
+        self.assertFalse(Author.objects.exists())
+
+    def test_inverse_reverts_relation_changes(self):
+        author = Author.objects.create(name='Bob')
+        book = Book.objects.create(author=author, title='Book One')
+        tags = [Tag.objects.create(name=name) for name in ('a', 'b', 'c')]
+        book.tags.add(tags[0], tags[1])
+
+        diff = [
+            {'op': 'add', 'path': '/tags/-', 'value': tags[2].pk},
+            {'op': 'remove', 'path': '/tags/0'},
+        ]
+
+        patch = Patch(diff)
+        changes = patch.apply(book)
+        changes.inverse.apply(book)
+
+        self.assertEqual(
+            sorted(book.tags.values_list('name', flat=True)), ['a', 'b'])
+
+    def test_inverse_reverts_document_changes(self):
+        data = {
+            'address': {'city': 'London'},
+            'imprints': ['Puffin', 'Pelican'],
+        }
+        publisher = Publisher.objects.create(name='Penguin', data=data)
+
+        diff = [
+            {'op': 'replace', 'path': '/data/address/city', 'value': 'Bath'},
+            {'op': 'add', 'path': '/data/address/country', 'value': 'UK'},
+            {'op': 'add', 'path': '/data/imprints/0', 'value': 'Ladybird'},
+            {'op': 'remove', 'path': '/data/imprints/2'},
+        ]
+
+        patch = Patch(diff)
+        changes = patch.apply(publisher)
+        changes.inverse.apply(publisher)
+
+        self.assertEqual(Publisher.objects.get().data, data)
+
+    def test_inverse_escapes_paths(self):
+        data = {'a/b': ['x'], 'c~d': 'y'}
+        publisher = Publisher.objects.create(name='Penguin', data=data)
+
+        diff = [
+            {'op': 'add', 'path': '/data/a~1b/0', 'value': 'w'},
+            {'op': 'replace', 'path': '/data/c~0d', 'value': 'z'},
+        ]
+
+        patch = Patch(diff)
+        changes = patch.apply(publisher)
+        self.assertEqual(changes.inverse.patch, [
+            {'op': 'replace', 'path': '/data/c~0d', 'value': 'y'},
+            {'op': 'remove', 'path': '/data/a~1b/0'},
+        ])
+
+        changes.inverse.apply(publisher)
+        self.assertEqual(Publisher.objects.get().data, data)
+
+    def test_inverse_is_empty_when_nothing_changed(self):
+        Author.objects.create(name='Jeff')
+
+        patch = Patch([
+            {'op': 'test', 'path': '/0/name', 'value': 'Jeff'}
+        ])
+        changes = patch.apply(Author.objects.all())
+
+        self.assertEqual(changes.inverse.patch, [])
+
+
+class TestPatchDatabaseRouting(TestCase):
+    multi_db = True
+
+    def setUp(self):
+        self.author = Author.objects.using('replica').create(name='Bob')
+        Book.objects.using('replica').create(author=self.author, title='Book One')
+
+    def test_test_operation_reads_from_replica(self):
+        test_book_diff = [
+            {'op': 'test', 'path': '/0/books/0/title', 'value': 'Book One'},
+            {'op': 'test', 'path': '/0/books/0/author/name', 'value': 'Bob'},
+        ]
+
+        patch = Patch(test_book_diff)
+        patch.apply(Author.objects.all(), read_using='replica', snapshot=True)
+
+        with self.assertRaises(PointerException):
+            patch.apply(Author.objects.all())
+
+    def test_writes_go_to_primary(self):
+        update_author_diff = [
+            {'op': 'replace', 'path': '/0/name', 'value': 'Jeff'},
+        ]
+
+        patch = Patch(update_author_diff)
+        patch.apply(Author.objects.all(), using='default', read_using='replica')
+
+        self.assertEqual(Author.objects.using('default').get(pk=self.author.pk).name, 'Jeff')
+        self.assertEqual(Author.objects.using('replica').get(pk=self.author.pk).name, 'Bob')
+
+    def test_writes_go_to_primary_when_only_reads_are_routed(self):
+        diff = [
+            {'op': 'replace', 'path': '/0/name', 'value': 'Jeff'},
+            {'op': 'remove', 'path': '/0/books/0'},
+        ]
+
+        patch = Patch(diff)
+        patch.apply(Author.objects.all(), read_using='replica')
+
+        self.assertEqual(Author.objects.using('default').get(pk=self.author.pk).name, 'Jeff')
+        self.assertEqual(Author.objects.using('replica').get(pk=self.author.pk).name, 'Bob')
+        self.assertEqual(Book.objects.using('replica').count(), 1)
+
+
+class TestPatchLocking(TestCase):
+
+    def setUp(self):
+        self.bob = Author.objects.create(name='Bob')
+        self.jeff = Author.objects.create(name='Jeff')
+        self.book = Book.objects.create(author=self.jeff, title='Book One')
+        self.diff = [
+            {'op': 'replace', 'path': '/1/name', 'value': 'Jeffrey'},
+            {'op': 'test', 'path': '/1/name', 'value': 'Jeffrey'},
+            {'op': 'remove', 'path': '/1/books/0'},
+            {'op': 'add', 'path': '/-', 'value': {'name': 'Jane'}},
+            {'op': 'replace', 'path': '/0/name', 'value': 'Robert'},
+            {'op': 'replace', 'path': '/5/name', 'value': 'Missing'},
+        ]
+
+    def test_written_rows_are_collected_in_order(self):
+        patch = Patch(self.diff)
+        targets = patch.get_lock_targets(Author.objects.all(), patch.get_operations())
+
+        self.assertEqual([(model, list(pks)) for model, pks in targets.items()], [
+            (Author, [self.bob.pk, self.jeff.pk]),
+            (Book, [self.book.pk]),
+        ])
+
+    def test_rows_are_refreshed_once_locked(self):
+        book = Book.objects.get()
+        patch = Patch([{'op': 'replace', 'path': '/author/name', 'value': 'Jeffrey'}])
+        patch.get_lock_targets(book, patch.get_operations())
+        Author.objects.filter(pk=self.jeff.pk).update(name='Concurrent')
+
+        changes = patch.apply(book, lock=True)
+
+        self.assertEqual(
+            changes.get(Author, self.jeff.pk).fields, {'name': ('Concurrent', 'Jeffrey')})
+
+    def test_lock_is_not_an_option(self):
+        for option in ('lock', 'using', 'read_using'):
+            with self.assertRaises(TypeError):
+                Patch(self.diff, **{option: True})
+
+    def test_patch_is_applied_with_locking(self):
+        patch = Patch(self.diff[:5])
+        patch.apply(Author.objects.all(), lock=True)
+
+        self.assertEqual(
+            list(Author.objects.order_by('pk').values_list('name', flat=True)),
+            ['Robert', 'Jeffrey', 'Jane'])
+        self.assertEqual(Book.objects.count(), 0)
+
+
+class InstanceRouter(object):
+    """
+    Router reading the model of the instance it is given.
+    """
+
+    def db_for_read(self, model, **hints):
+        if 'instance' in hints:
+            hints['instance']._meta
+        return None
+
+
+class TestPatchApplyMany(TestCase):
+
+    def setUp(self):
+        self.authors = [Author.objects.create(name=name) for name in ('Bob', 'Jeff', 'Jane')]
+
+    def test_constant_replace_is_applied_with_one_update(self):
+        patch = Patch([
+            {'op': 'replace', 'path': '/name', 'value': 'Anonymous'}
+        ])
+        authors = Author.objects.exclude(name='Jane')
+        with self.assertNumQueries(4):
+            # Savepoint, old values, update, release savepoint
+            changes = patch.apply_many(authors)
+
+        self.assertEqual(
+            list(Author.objects.order_by('pk').values_list('name', flat=True)),
+            ['Anonymous', 'Anonymous', 'Jane'])
+        self.assertEqual(
+            changes.get(Author, self.authors[1].pk).fields, {'name': ('Jeff', 'Anonymous')})
+
+    @override_settings(DATABASE_ROUTERS=['tests.test_patch.InstanceRouter'])
+    def test_constant_relation_replace_is_validated_with_an_instance(self):
+        book = Book.objects.create(author=self.authors[0], title='Book One')
+
+        patch = Patch([{'op': 'replace', 'path': '/author', 'value': self.authors[1].pk}])
+        patch.apply_many(Book.objects.all())
+
+        self.assertEqual(Book.objects.get(pk=book.pk).author, self.authors[1])
+
+    def test_sliced_queryset(self):
+        for author in self.authors:
+            Book.objects.create(author=author, title='Book One')
+        authors = Author.objects.order_by('pk')[:2]
+
+        for diff in (
+            [{'op': 'replace', 'path': '/name', 'value': 'Anonymous'}],
+            [{'op': 'remove', 'path': '/books/0'}],
+        ):
+            Patch(diff).apply_many(authors)
+
+        self.assertEqual(
+            list(Author.objects.order_by('pk').values_list('name', flat=True)),
+            ['Anonymous', 'Anonymous', 'Jane'])
+        self.assertEqual(list(Book.objects.values_list('author', flat=True)), [self.authors[2].pk])
+
+    def test_constant_replace_is_validated(self):
+        patch = Patch([
+            {'op': 'replace', 'path': '/name', 'value': 'J' * 256}
+        ])
+        with self.assertRaises(PatchException):
+            patch.apply_many(Author.objects.all())
+
+    def test_other_operations_are_applied_to_each_instance(self):
+        for author in self.authors:
+            Book.objects.create(author=author, title='Book One')
+            Book.objects.create(author=author, title='Book Two')
+
+        patch = Patch([
+            {'op': 'remove', 'path': '/books/0'},
+            {'op': 'replace', 'path': '/name', 'value': 'Anonymous'},
+        ], chunk_size=2)
+        changes = patch.apply_many(Author.objects.all())
+
+        self.assertEqual(
+            list(Book.objects.values_list('title', flat=True)), ['Book Two'] * 3)
+        self.assertEqual(Author.objects.filter(name='Anonymous').count(), 3)
+        self.assertEqual(len(changes.deleted), 3)
+        self.assertIsNone(patch.inverse_operations)
+
+
+class TestPatchSignals(TestCase):
+
+    def setUp(self):
+        self.author = Author.objects.create(name='Jeff')
+        self.book = Book.objects.create(author=self.author, title='Book One')
+
+        self.model_signals = []
+        self.patch_signals = []
+
+        for signal in (pre_save, post_save, pre_delete, post_delete):
+            signal.connect(self.model_signal_receiver)
+            self.addCleanup(signal.disconnect, self.model_signal_receiver)
+        patch_applied.connect(self.patch_signal_receiver)
+        self.addCleanup(patch_applied.disconnect, self.patch_signal_receiver)
+
+        self.diff = [
+            {'op': 'replace', 'path': '/0/name', 'value': 'Bob'},
+            {'op': 'add', 'path': '/-', 'value': {'name': 'Jane'}},
+            {'op': 'remove', 'path': '/0'},
+        ]
+
+    def model_signal_receiver(self, sender, **kwargs):
+        self.model_signals.append(sender)
+
+    def patch_signal_receiver(self, sender, **kwargs):
+        self.patch_signals.append(kwargs)
+
+    def test_model_signals_are_sent_by_default(self):
+        patch = Patch(self.diff)
+        patch.apply(Author.objects.all())
+
+        self.assertTrue(self.model_signals)
+        self.assertEqual(len(self.patch_signals), 1)
+
+    def test_model_signals_are_suppressed(self):
+        patch = Patch(self.diff, model_signals=False)
+        patch.apply(Author.objects.all())
+
+        self.assertEqual(self.model_signals, [])
+        author = Author.objects.get()
+        self.assertEqual(author.name, 'Jane')
+        self.assertEqual(Book.objects.count(), 0)
+
+        self.assertEqual(len(self.patch_signals), 1)
+        kwargs = self.patch_signals[0]
+        self.assertEqual(kwargs['created'], [(Author, author.pk, ('name', ))])
+        self.assertEqual(kwargs['updated'], [])
+        self.assertEqual(
+            sorted(kwargs['deleted'], key=lambda triple: triple[0].__name__),
+            [(Author, self.author.pk, ()), (Book, self.book.pk, ())])
+
+    def test_patch_signal_not_sent_when_nothing_changed(self):
+        patch = Patch([
+            {'op': 'test', 'path': '/0/name', 'value': 'Jeff'}
+        ])
+        patch.apply(Author.objects.all())
+
+        self.assertEqual(self.patch_signals, [])
+
+
+class TestPatchDocumentOperations(TestCase):
+
+    def setUp(self):
+        self.publisher = Publisher.objects.create(name='Penguin', data={
+            'address': {'city': 'London'},
+            'imprints': ['Puffin', 'Pelican'],
+        })
+
+    def get_data(self):
+        return Publisher.objects.get(pk=self.publisher.pk).data
+
+    def test_nested_key_is_replaced(self):
+        patch = Patch([
+            {'op': 'replace', 'path': '/data/address/city', 'value': 'Bath'}
+        ])
+        patch.apply(self.publisher)
+
+        self.assertEqual(self.get_data()['address'], {'city': 'Bath'})
+
+    def test_nested_key_is_added(self):
+        patch = Patch([
+            {'op': 'add', 'path': '/data/address/country', 'value': 'UK'}
+        ])
+        patch.apply(self.publisher)
+
+        self.assertEqual(self.get_data()['address'], {'city': 'London', 'country': 'UK'})
+
+    def test_list_entry_is_inserted_and_appended(self):
+        patch = Patch([
+            {'op': 'add', 'path': '/data/imprints/0', 'value': 'Ladybird'},
+            {'op': 'add', 'path': '/data/imprints/-', 'value': 'Vintage'},
+        ])
+        patch.apply(self.publisher)
+
+        self.assertEqual(
+            self.get_data()['imprints'], ['Ladybird', 'Puffin', 'Pelican', 'Vintage'])
+
+    def test_list_entry_is_removed(self):
+        patch = Patch([
+            {'op': 'remove', 'path': '/data/imprints/0'}
+        ])
+        patch.apply(self.publisher)
+
+        self.assertEqual(self.get_data()['imprints'], ['Pelican'])
+
+    def test_nested_value_is_tested(self):
+        patch = Patch([
+            {'op': 'test', 'path': '/data/imprints/1', 'value': 'Pelican'}
+        ])
+        patch.apply(self.publisher)
+
+    def test_exception_thrown_when_replacing_missing_key(self):
+        patch = Patch([
+            {'op': 'replace', 'path': '/data/address/country', 'value': 'UK'}
+        ])
+        with self.assertRaises(PatchException):
+            patch.apply(self.publisher)
+
+    def test_exception_thrown_when_path_does_not_exist(self):
+        patch = Patch([
+            {'op': 'replace', 'path': '/data/missing/city', 'value': 'Bath'}
+        ])
+        with self.assertRaises(PointerException):
+            patch.apply(self.publisher)
+
+
+class TestPatchIdempotency(TestCase):
+    add_author = [{'op': 'add', 'path': '/-', 'value': {'name': 'Jeff'}}]
+
+    def tearDown(self):
+        cache.clear()
+
+    def test_retry_returns_stored_changes_without_queries(self):
+        changes = Patch(self.add_author).apply(Author.objects.all(), idempotency_key='abc')
+
+        with self.assertNumQueries(0):
+            retried = Patch(self.add_author).apply(Author.objects.all(), idempotency_key='abc')
+
+        self.assertEqual(Author.objects.count(), 1)
+        self.assertEqual(
+            [(change.action, change.pk) for change in retried],
+            [(change.action, change.pk) for change in changes])
+
+    def test_key_depends_on_token_and_patch(self):
+        Patch(self.add_author).apply(Author.objects.all(), idempotency_key='abc')
+        Patch(self.add_author).apply(Author.objects.all(), idempotency_key='def')
+        Patch([{'op': 'add', 'path': '/-', 'value': {'name': 'Bob'}}]).apply(
+            Author.objects.all(), idempotency_key='abc')
+
+        self.assertEqual(Author.objects.count(), 3)
+
+    def test_key_depends_on_target(self):
+        jeff = Author.objects.create(name='Jeff')
+        bob = Author.objects.create(name='Bob')
+        diff = [{'op': 'replace', 'path': '/name', 'value': 'Jane'}]
+
+        Patch(diff).apply(jeff, idempotency_key='abc')
+        changes = Patch(diff).apply(bob, idempotency_key='abc')
+
+        self.assertEqual(changes.get(Author, bob.pk).fields, {'name': ('Bob', 'Jane')})
+        self.assertEqual(Author.objects.filter(name='Jane').count(), 2)
+
+    def test_dry_run_is_not_cached(self):
+        Patch(self.add_author).apply(Author.objects.all(), save=False, idempotency_key='abc')
+        Patch(self.add_author).apply(Author.objects.all(), idempotency_key='abc')
+
+        self.assertEqual(Author.objects.count(), 1)
+
+    def test_patch_with_model_instance_value(self):
+        author = Author.objects.create(name='Bob')
+        book = Book.objects.create(author=author, title='Book One')
+        tag = Tag.objects.create(name='a')
+
+        diff = [{'op': 'add', 'path': '/tags/-', 'value': tag}]
+        Patch(diff).apply(book, idempotency_key='abc')
+
+        with self.assertNumQueries(0):
+            Patch(diff).apply(book, idempotency_key='abc')
+        self.assertEqual(list(book.tags.all()), [tag])
+
+    def test_failed_patch_can_be_retried(self):
+        patch = Patch([{'op': 'test', 'path': '/0/name', 'value': 'Jeff'}])
+        with self.assertRaises(PointerException):
+            patch.apply(Author.objects.all(), idempotency_key='abc')
+
+        self.assertIsNone(cache.get(patch.get_idempotency_key('abc', Author.objects.all())))
+
+    def test_exception_thrown_while_patch_is_pending(self):
+        patch = Patch(self.add_author)
+        cache.set(patch.get_idempotency_key('abc', Author.objects.all()), IDEMPOTENCY_PENDING)
+
+        with self.assertRaises(PatchException):
+            patch.apply(Author.objects.all(), idempotency_key='abc')
+        self.assertEqual(Author.objects.count(), 0)
+
+
+class TestPatchImports(SimpleTestCase):
+    # Seconds allowed for importing the patch module, well above the time
+    # taken without forms and the ORM
+    import_budget = 0.5
+
+    script = """
+import json, sys, time
+start = time.time()
+from json_patch.patch import Patch
+elapsed = time.time() - start
+Patch([{'op': 'replace', 'path': '/0/name', 'value': 'Jeff'}]).validate()
+print(json.dumps({
+    'elapsed': elapsed,
+    'loaded': [name for name in ('django.forms', 'django.db.models') if name in sys.modules],
+}))
+"""
+
+    def run_script(self):
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        output = subprocess.check_output([sys.executable, '-c', self.script], cwd=root)
+        return json.loads(output.decode('utf-8'))
+
+    def test_validation_does_not_load_forms_or_orm(self):
+        result = self.run_script()
+        self.assertEqual(result['loaded'], [])
+
+    def test_import_within_budget(self):
+        result = self.run_script()
+        self.assertLess(result['elapsed'], self.import_budget)